@@ -5,26 +5,66 @@ MULTI-DOMAIN VERSION
 """
 
 import argparse
+import atexit
+import csv
+import functools
+import hashlib
+import orjson
 import os
+import queue
 import re
 import requests
+import sqlite3
 import sys
 import threading
 import time
 import json
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from itertools import cycle
-from typing import Dict, List, Set, Tuple
+from typing import Dict, List, Set, TextIO, Tuple
 
+SERPAPI_URL = "https://serpapi.com/search"
 NUM_PER_PAGE = 100
+WRITE_BUFFER = 1 << 20
 DEFAULT_THREADS = 8
 DEFAULT_PAGES = 1
 DEFAULT_DELAY = 0.8
 MONTHLY_QUOTA = 250
 USAGE_FILE = "quota_usage.json"
+CURRENT_MONTH = datetime.now().strftime("%Y-%m")
+CACHE_FILE = "serp_cache.sqlite"
 RETRIES = 3
 BACKOFF = 2.0
+RESULT_BATCH = 16
+
+# One keep-alive session per worker thread, so each reuses its own
+# connection to serpapi.com instead of doing a TCP+TLS handshake per call.
+_tls = threading.local()
+_sessions: List[requests.Session] = []
+_sessions_lock = threading.Lock()
+
+
+def _session() -> requests.Session:
+    s = getattr(_tls, "session", None)
+    if s is None:
+        s = requests.Session()
+        # Each session serves one thread, so one pooled connection is enough.
+        s.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        _tls.session = s
+        with _sessions_lock:
+            _sessions.append(s)
+    return s
+
+
+@atexit.register
+def _close_sessions():
+    with _sessions_lock:
+        for s in _sessions:
+            s.close()
+        _sessions.clear()
+
 
 class Spinner:
     def __init__(self, text="Working"):
@@ -54,6 +94,39 @@ class Spinner:
             self._thread.join()
 
 
+class _NullSpinner:
+    """Stand-in for Spinner when stdout is not a terminal."""
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class TokenBucket:
+    """Shared request pacer: callers take a token before each API call."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Reserve the token up front (going negative if need be) so
+            # concurrent callers queue up behind each other in order.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
 def load_usage() -> int:
     if not os.path.exists(USAGE_FILE):
         return 0
@@ -63,17 +136,85 @@ def load_usage() -> int:
     except:
         return 0
 
-    if data.get("month") != datetime.now().strftime("%Y-%m"):
+    if data.get("month") != CURRENT_MONTH:
         return 0
     return data.get("used", 0)
 
 
 def save_usage(used: int):
-    data = {"month": datetime.now().strftime("%Y-%m"), "used": used}
+    data = {"month": CURRENT_MONTH, "used": used}
     with open(USAGE_FILE, "w") as f:
         json.dump(data, f)
 
 
+# SerpAPI responses cached on disk per (query, start) for the current month,
+# so re-running the same dorks does not spend credits again.
+_caches: List[sqlite3.Connection] = []
+_caches_lock = threading.Lock()
+_cache_since = 0
+
+
+def _cache() -> sqlite3.Connection:
+    db = getattr(_tls, "cache", None)
+    if db is None:
+        # Only ever used by its own thread; check_same_thread is off so the
+        # atexit hook can close it from the main thread.
+        db = sqlite3.connect(CACHE_FILE, timeout=30, isolation_level=None,
+                             check_same_thread=False)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS cache "
+                       "(key TEXT PRIMARY KEY, ts INTEGER, json BLOB)")
+        except sqlite3.Error:
+            db.close()
+            raise
+        _tls.cache = db
+        with _caches_lock:
+            _caches.append(db)
+    return db
+
+
+def cache_key(query: str, start: int) -> str:
+    return hashlib.blake2b(f"{query}|{start}".encode(), digest_size=16).hexdigest()
+
+
+def prune_cache():
+    """Drop entries from earlier months; called once before the scan."""
+    global _cache_since
+    _cache_since = int(datetime.strptime(CURRENT_MONTH, "%Y-%m").timestamp())
+    try:
+        _cache().execute("DELETE FROM cache WHERE ts < ?", (_cache_since,))
+    except sqlite3.Error:
+        pass
+
+
+def cache_get(key: str):
+    # Unreadable or corrupt entries are treated as misses.
+    try:
+        row = _cache().execute("SELECT json FROM cache WHERE key = ? AND ts >= ?",
+                               (key, _cache_since)).fetchone()
+        return orjson.loads(row[0]) if row else None
+    except (sqlite3.Error, orjson.JSONDecodeError):
+        return None
+
+
+def cache_put(key: str, data: dict):
+    # A failed write only costs a future cache miss; never fail the search.
+    try:
+        _cache().execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                         (key, int(time.time()), orjson.dumps(data)))
+    except sqlite3.Error:
+        pass
+
+
+@atexit.register
+def _close_caches():
+    with _caches_lock:
+        for db in _caches:
+            db.close()
+        _caches.clear()
+
+
 def load_categorized_dorks(path: str) -> Dict[str, List[str]]:
     categories = {}
     current = None
@@ -82,16 +223,18 @@ def load_categorized_dorks(path: str) -> Dict[str, List[str]]:
             l = line.strip()
             if not l or l.startswith("#"):
                 continue
-            m = re.match(r"^\[(.+?)\]$", l)
-            if m:
-                current = m.group(1)
-                categories.setdefault(current, [])
+            if l.startswith("[") and l.endswith("]"):
+                # A blank header is malformed; skip it rather than query it.
+                name = l[1:-1].strip()
+                if name:
+                    current = name
+                    categories.setdefault(current, [])
                 continue
             if current is None:
                 current = "Uncategorized"
                 categories.setdefault(current, [])
             categories[current].append(l)
-    return categories
+    return {c: list(dict.fromkeys(ds)) for c, ds in categories.items()}
 
 
 def ensure_dir(path: str):
@@ -106,45 +249,75 @@ def serpapi_search(query: str, api_key: str, start: int):
         "start": str(start),
         "api_key": api_key
     }
-    r = requests.get("https://serpapi.com/search", params=params, timeout=20)
+    r = _session().get(SERPAPI_URL, params=params, timeout=20)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
 
 def extract_urls(data: dict) -> Set[str]:
-    urls = set()
-    for r in data.get("organic_results", []):
-        link = r.get("link")
-        if link:
-            urls.add(link)
-    return urls
+    return {r["link"] for r in data.get("organic_results", ()) if r.get("link")}
+
+
+_SANITIZE_RE = re.compile(r"example(?:\.|\[\.\])com")
 
 
 def sanitize(dork: str, domain: str) -> str:
-    return dork.replace("example.com", domain).replace("example[.]com", domain)
+    return _SANITIZE_RE.sub(lambda _: domain, dork)
 
 
-def process_dork(domain, category, dork, api_key, pages, delay):
-    q = sanitize(dork, domain)
-    found = set()
-    for p in range(pages):
-        start = p * NUM_PER_PAGE
-        attempt = 0
-        while attempt <= RETRIES:
+def fetch_page(query, api_key, start, bucket, use_cache=True) -> Set[str]:
+    key = cache_key(query, start)
+    if use_cache:
+        data = cache_get(key)
+        if data is not None:
             try:
-                data = serpapi_search(q, api_key, start)
-                found.update(extract_urls(data))
-                break
+                return extract_urls(data)
             except:
-                attempt += 1
-                if attempt > RETRIES:
-                    pass
-                else:
-                    time.sleep(BACKOFF ** attempt)
-        time.sleep(delay)
+                pass
+
+    attempt = 0
+    while attempt <= RETRIES:
+        try:
+            if bucket:
+                bucket.acquire()
+            data = serpapi_search(query, api_key, start)
+            cache_put(key, data)
+            return extract_urls(data)
+        except:
+            attempt += 1
+            if attempt <= RETRIES:
+                time.sleep(BACKOFF ** attempt)
+    return set()
+
+
+def process_dork(domain, category, dork, q, *, api_key, pages, bucket, page_pool=None,
+                 use_cache=True):
+    starts = [p * NUM_PER_PAGE for p in range(pages)]
+    found = set()
+    if page_pool is None or pages == 1:
+        for start in starts:
+            found.update(fetch_page(q, api_key, start, bucket, use_cache))
+    else:
+        # Pages of one query are independent; hand the extra pages to the
+        # pool and fetch the first one on this thread meanwhile.
+        futures = [page_pool.submit(fetch_page, q, api_key, start, bucket, use_cache)
+                   for start in starts[1:]]
+        found.update(fetch_page(q, api_key, starts[0], bucket, use_cache))
+        for f in futures:
+            found.update(f.result())
     return domain, category, dork, found
 
 
+def worker_loop(jobs: queue.SimpleQueue, results: queue.SimpleQueue, work):
+    while (item := jobs.get()) is not None:
+        # Always post something so the main thread's count advances; an
+        # exception is handed over for main() to re-raise.
+        try:
+            results.put(work(*item))
+        except Exception as e:
+            results.put(e)
+
+
 def main():
     print("Dorking Quack 🦆 (Multi-domain)\n")
 
@@ -160,19 +333,35 @@ def main():
     parser.add_argument("--pages", type=int, default=2)
     parser.add_argument("--threads", type=int, default=8)
     parser.add_argument("--delay", type=float, default=0.8)
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Max API requests/sec across all threads\n"
+                             "(default: threads / delay)")
     parser.add_argument("--csv", action="store_true")
+    parser.add_argument("--no-cache", action="store_true",
+                        help=f"Ignore cached responses in {CACHE_FILE}\n"
+                             "(fresh results are still written to it)")
 
     args = parser.parse_args()
+    if args.threads < 1:
+        parser.error("--threads must be at least 1")
+    if args.delay < 0:
+        parser.error("--delay must not be negative")
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be greater than 0")
 
     domains = [x.strip() for x in args.domains.split(",") if x.strip()]
 
     categories = load_categorized_dorks(args.dorks)
 
-    tasks = []
+    # The same query for the same domain (duplicate lines, or a dork listed
+    # under several categories) would burn quota twice; keep the first.
+    planned: Dict[Tuple[str, str], Tuple[str, str, str, str]] = {}
     for domain in domains:
         for c in categories:
             for d in categories[c]:
-                tasks.append((domain, c, d))
+                q = sanitize(d, domain)
+                planned.setdefault((domain, q), (domain, c, d, q))
+    tasks = list(planned.values())
 
     total_dorks = len(tasks)
 
@@ -181,51 +370,118 @@ def main():
         print("Aborted.")
         return
 
-    spinner = Spinner("Scanning")
+    rate = args.rate
+    if rate is None and args.delay > 0:
+        rate = args.threads / args.delay
+    bucket = TokenBucket(rate, burst=args.threads) if rate else None
+
+    interactive = sys.stdout.isatty()
+    spinner = Spinner("Scanning") if interactive else _NullSpinner()
     spinner.start()
 
     ensure_dir("output")
+    for domain, category in {(d, c) for d, c, _, _ in tasks}:
+        ensure_dir(f"output/{domain}/{category}")
 
-    lock = threading.Lock()
     domain_urls = {d: set() for d in domains}
 
-    futures = []
-    with ThreadPoolExecutor(max_workers=args.threads) as ex:
-        for (domain, c, dork_text) in tasks:
-            futures.append(ex.submit(
-                process_dork, domain, c, dork_text,
-                args.apikey, args.pages, args.delay
-            ))
-
-        done = 0
-        for f in as_completed(futures):
-            done += 1
-            domain, category, dork_text, urls = f.result()
+    # URLs already in each (domain, category) urls.txt; read from disk once
+    # on first touch and kept in memory afterwards.
+    seen: Dict[Tuple[str, str], Set[str]] = {}
+
+    # One handle per (domain, category) output file, kept open for the run.
+    url_files: Dict[Tuple[str, str], TextIO] = {}
+    csv_files: Dict[Tuple[str, str], TextIO] = {}
+    csv_writers = {}
+
+    prune_cache()
+
+    jobs = queue.SimpleQueue()
+    results = queue.SimpleQueue()
+    for task in tasks:
+        jobs.put(task)
+    # Sized so every worker's extra pages can be in flight at once.
+    page_pool = None
+    if args.pages > 1:
+        page_pool = ThreadPoolExecutor(max_workers=args.threads * (args.pages - 1))
+    work = functools.partial(process_dork, api_key=args.apikey, pages=args.pages,
+                             bucket=bucket, page_pool=page_pool,
+                             use_cache=not args.no_cache)
+    workers = []
+    for _ in range(args.threads):
+        jobs.put(None)
+        t = threading.Thread(target=worker_loop, daemon=True,
+                             args=(jobs, results, work))
+        t.start()
+        workers.append(t)
+
+    # Workers only fetch; this thread is the single consumer of `results`
+    # and the only writer of the sets and files below, so none of it is
+    # shared state that needs a lock.
+    done = 0
+    while done < total_dorks:
+        # Block for one result, then pick up whatever else is already
+        # waiting so output and progress are handled in batches.
+        batch = [results.get()]
+        while len(batch) < RESULT_BATCH:
+            try:
+                batch.append(results.get_nowait())
+            except queue.Empty:
+                break
+        done += len(batch)
 
+        for result in batch:
+            if isinstance(result, Exception):
+                raise result
+            domain, category, dork_text, urls = result
             outdir = f"output/{domain}/{category}"
-            ensure_dir(outdir)
 
             out_file = f"{outdir}/urls.txt"
-            old = set()
-            if os.path.exists(out_file):
-                old = {x.strip() for x in open(out_file).read().splitlines()}
+            key = (domain, category)
+            old = seen.get(key)
+            if old is None:
+                old = seen[key] = set()
+                if os.path.exists(out_file):
+                    with open(out_file, "r") as fh:
+                        old.update(x.strip() for x in fh if x.strip())
+
+            new = urls - old
+            old |= new
+            if new:
+                fw = url_files.get(key)
+                if fw is None:
+                    fw = url_files[key] = open(out_file, "a", buffering=WRITE_BUFFER)
+                fw.write("\n".join(new) + "\n")
+
+            if args.csv and new:
+                cw = csv_writers.get(key)
+                if cw is None:
+                    fw = csv_files[key] = open(f"{outdir}/results.csv", "a", newline="",
+                                               buffering=WRITE_BUFFER)
+                    cw = csv_writers[key] = csv.writer(fw, quoting=csv.QUOTE_ALL,
+                                                       lineterminator="\n")
+                cw.writerows([(category, dork_text, u) for u in new])
+
+            domain_urls[domain].update(urls)
+
+        if interactive:
+            print(f"\rProcessed {done}/{total_dorks}", end="")
 
-            new = sorted(set(urls) - old)
-            with open(out_file, "a") as fw:
-                fw.writelines([u + "\n" for u in new])
+    for t in workers:
+        t.join()
+    if page_pool:
+        page_pool.shutdown()
 
-            if args.csv:
-                with open(f"{outdir}/results.csv", "a") as fw:
-                    for u in new:
-                        safe = dork_text.replace('"', "'")
-                        fw.write(f'"{category}","{safe}","{u}"\n')
+    spinner.stop()
 
-            with lock:
-                domain_urls[domain].update(urls)
+    for fw in (*url_files.values(), *csv_files.values()):
+        fw.close()
 
-            print(f"\rProcessed {done}/{total_dorks}", end="")
-
-    spinner.stop()
+    # urls.txt files were appended to unsorted as results came in; rewrite
+    # each one that changed sorted, once, now the run is over.
+    for key, fw in url_files.items():
+        with open(fw.name, "w") as fh:
+            fh.writelines(u + "\n" for u in sorted(seen[key]))
 
     print("\n\n[✓] Finished.")
 